@@ -1,56 +1,255 @@
-from flask import Flask, render_template, Response
+from flask import Flask, render_template, Response, request
+import atexit
 import cv2
+import json
+import os
+import queue
 import threading
+import time
 import winsound
-from detection import DrowsinessDetector
+from detection import DrowsinessDetector, FaceModel
+
+try:
+    from nvjpeg import NvJpeg
+    nvjpeg = NvJpeg()
+except Exception:  # not installed, or no CUDA device to bind to
+    nvjpeg = None
+
+try:
+    from turbojpeg import TurboJPEG, TJPF_BGR, TJSAMP_420
+    turbojpeg = TurboJPEG()
+except Exception:  # not installed, or libjpeg-turbo shared library not found
+    turbojpeg = None
+
+JPEG_QUALITY = 75
+# Each open dashboard holds two long-lived requests (/video_feed and /metrics). Both are
+# capped at MAX_CLIENTS and refused with 503 beyond that, so the extra thread is always
+# free for page loads.
+MAX_CLIENTS = int(os.environ.get('MAX_CLIENTS', 4))
+SERVER_THREADS = 2 * MAX_CLIENTS + 1
+video_slots = threading.BoundedSemaphore(MAX_CLIENTS)
+metrics_slots = threading.BoundedSemaphore(MAX_CLIENTS)
 
 app = Flask(__name__)
-detector = DrowsinessDetector()
 
-alarm_playing = False
+# Idle FaceModels; each stream checks one out so MediaPipe's tracking state isn't shared
+models = queue.Queue()
+models.put(FaceModel())
+
+METRICS_INTERVAL = 0.1  # seconds between /metrics updates
+STREAM_START_TIMEOUT = 5.0  # seconds /metrics waits for its /video_feed to start
+
+# Latest detector readings per client, rendered client-side instead of drawn into the frame.
+# A client has an entry exactly while its /video_feed is running.
+NO_METRICS = {'ear': None, 'mar': None, 'alert': ''}
+metrics = {}
+metrics_lock = threading.Lock()
+
+alarm_requested = threading.Event()
 
 def sound_alarm():
-    global alarm_playing
-    if not alarm_playing:
-        alarm_playing = True
+    # Frames that ask for the alarm while it's beeping are absorbed by clear()
+    while True:
+        alarm_requested.wait()
         winsound.Beep(1000, 1000)  
-        alarm_playing = False
+        alarm_requested.clear()
+
+threading.Thread(target=sound_alarm, daemon=True).start()
+
+def encode_jpeg(frame):
+    # Returns fresh bytes on purpose: the caller copies them into the multipart chunk
+    # anyway, so encoding into a reused destination (e.g. TurboJPEG dst=) saves nothing
+    if nvjpeg is not None:
+        return nvjpeg.encode(frame, JPEG_QUALITY)
+    if turbojpeg is not None:
+        return turbojpeg.encode(frame, quality=JPEG_QUALITY, pixel_format=TJPF_BGR,
+                                jpeg_subsample=TJSAMP_420)
+    ret, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY])
+    return buffer.tobytes()
+
+def put_latest(q, item):
+    # Stages only care about the newest frame, so drop whatever is still waiting
+    try:
+        q.put_nowait(item)
+    except queue.Full:
+        try:
+            q.get_nowait()
+        except queue.Empty:
+            pass
+        q.put_nowait(item)
+
+def run_stage(stage, stop, errors, *args):
+    # A failing stage stops the whole pipeline and hands its error to generate_frames
+    try:
+        stage(*args, stop)
+    except Exception as exc:
+        errors.append(exc)
+    finally:
+        stop.set()
+
+class SharedCamera:
+    # A webcam usually can't be opened twice, so one capture thread feeds every stream.
+    # It opens the device for the first subscriber and releases it after the last one leaves.
+    def __init__(self, index=0):
+        self.index = index
+        self._lock = threading.Lock()
+        self._subscribers = {}  # frames queue -> (stop event, errors list)
+        self._thread = None
 
-def generate_frames():
-    cap = cv2.VideoCapture(0)
+    def subscribe(self, frames, stop, errors):
+        with self._lock:
+            self._subscribers[frames] = (stop, errors)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
 
+    def unsubscribe(self, frames):
+        with self._lock:
+            self._subscribers.pop(frames, None)
+
+    def _run(self):
+        cap = cv2.VideoCapture(self.index)
+        failed = False
+        error = None
+        while True:
+            with self._lock:
+                # Deciding to stop and releasing the device happen under one lock, so a
+                # stream subscribing meanwhile either gets frames or starts a fresh thread
+                if failed or not self._subscribers:
+                    cap.release()
+                    for stop, errors in self._subscribers.values():
+                        if error is not None:
+                            errors.append(error)
+                        stop.set()
+                    self._subscribers.clear()
+                    self._thread = None
+                    return
+                subscribers = list(self._subscribers)
+            try:
+                success, frame = cap.read()
+            except Exception as exc:
+                failed, error = True, exc
+                continue
+            if not success:
+                # Camera stopped delivering frames; streams end without an error
+                failed = True
+                continue
+            for frames in subscribers:
+                put_latest(frames, frame)
+
+def detect_frames(detector, frames, results, stop):
+    while not stop.is_set():
+        try:
+            frame = frames.get(timeout=0.5)
+        except queue.Empty:
+            continue
+        ear, mar, alert_text, result = detector.process_frame(frame)
+        put_latest(results, (frame, ear, mar, alert_text))
+
+camera = SharedCamera(0)
+
+def acquire_model():
+    try:
+        return models.get_nowait()
+    except queue.Empty:
+        return FaceModel()
+
+def close_models():
     while True:
-        success, frame = cap.read()
-        if not success:
+        try:
+            models.get_nowait().close()
+        except queue.Empty:
             break
 
-        ear, mar, alert_text, result = detector.process_frame(frame)
+atexit.register(close_models)
+
+def generate_frames(client_id):
+    model = acquire_model()
+    detector = DrowsinessDetector(model)
+    frames = queue.Queue(maxsize=1)
+    results = queue.Queue(maxsize=1)
+    stop = threading.Event()
+    errors = []
+    with metrics_lock:
+        metrics[client_id] = NO_METRICS
+    camera.subscribe(frames, stop, errors)
+    worker = threading.Thread(target=run_stage, daemon=True,
+                              args=(detect_frames, stop, errors, detector, frames, results))
+    worker.start()
 
-        if alert_text:
-            threading.Thread(target=sound_alarm).start()
-            cv2.putText(frame, alert_text, (10, 90),
-                        cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 0, 255), 2)
+    try:
+        while True:
+            try:
+                frame, ear, mar, alert_text = results.get(timeout=0.5)
+            except queue.Empty:
+                if stop.is_set():
+                    if errors:
+                        raise errors[0]
+                    break
+                continue
 
-        if ear:
-            cv2.putText(frame, f'EAR: {ear:.2f}', (10, 30),
-                        cv2.FONT_HERSHEY_SIMPLEX, 0.7, (255, 255, 0), 2)
-        if mar:
-            cv2.putText(frame, f'MAR: {mar:.2f}', (10, 60),
-                        cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 255), 2)
+            if alert_text:
+                alarm_requested.set()
+            with metrics_lock:
+                metrics[client_id] = {'ear': ear, 'mar': mar, 'alert': alert_text}
 
-        ret, buffer = cv2.imencode('.jpg', frame)
-        frame = buffer.tobytes()
-        yield (b'--frame\r\n'
-               b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n')
+            frame = encode_jpeg(frame)
+            yield (b'--frame\r\n'
+                   b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n')
+    finally:
+        stop.set()
+        camera.unsubscribe(frames)
+        worker.join()
+        models.put(model)
+        with metrics_lock:
+            metrics.pop(client_id, None)
 
 @app.route('/')
 def index():
     return render_template('index.html')
 
+def limited_stream(slots, make_response):
+    if not slots.acquire(blocking=False):
+        return Response('Too many open dashboards', status=503)
+    response = make_response()
+    # Runs when the server closes the response, even if the generator never started
+    response.call_on_close(slots.release)
+    return response
+
 @app.route('/video_feed')
 def video_feed():
-    return Response(generate_frames(),
-                    mimetype='multipart/x-mixed-replace; boundary=frame')
+    client_id = request.args.get('client', '')
+    return limited_stream(video_slots, lambda: Response(
+        generate_frames(client_id),
+        mimetype='multipart/x-mixed-replace; boundary=frame'))
+
+def event_stream(client_id):
+    deadline = time.monotonic() + STREAM_START_TIMEOUT
+    started = False
+    while True:
+        with metrics_lock:
+            current = metrics.get(client_id)
+        if current is not None:
+            started = True
+            yield f'data: {json.dumps(current)}\n\n'
+        elif started or time.monotonic() > deadline:
+            # The video stream is gone (or never came); tell the page not to reconnect
+            yield 'event: end\ndata: {}\n\n'
+            return
+        time.sleep(METRICS_INTERVAL)
+
+@app.route('/metrics')
+def metrics_feed():
+    client_id = request.args.get('client', '')
+    return limited_stream(metrics_slots, lambda: Response(
+        event_stream(client_id),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache'}))
 
 if __name__ == '__main__':
-    app.run(debug=True)
+    try:
+        from waitress import serve
+    except ImportError:
+        app.run(threaded=True)
+    else:
+        serve(app, host='127.0.0.1', port=5000, threads=SERVER_THREADS)
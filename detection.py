@@ -1,7 +1,14 @@
+import os
+import threading
+import time
 import cv2
 import numpy as np
 import mediapipe as mp
-from datetime import datetime, timedelta
+from mediapipe.tasks import python as mp_tasks
+from mediapipe.tasks.python import vision
+from collections import deque
+from datetime import datetime
+from kernels import ear_mar
 
 
 LEFT_EYE = [33, 160, 158, 133, 153, 144]
@@ -12,103 +19,199 @@ MOUTH_BOTTOM_LIP = 14
 MOUTH_LEFT_CORNER = 78
 MOUTH_RIGHT_CORNER = 308
 
+NUM_LANDMARKS = 478  # 468 mesh points + 10 iris points from refined landmarks
+
 EAR_THRESHOLD = 0.25      
 MAR_THRESHOLD = 0.6       
-CONSEC_EYE_FRAMES = 50    
-YAWN_CONSEC_FRAMES = 15   
-YAWN_TIME_WINDOW = timedelta(minutes=30) 
-YAWN_ALERT_COOLDOWN = timedelta(minutes=10) 
+# Run lengths are timed, not counted, because the pipeline infers at whatever rate
+# MediaPipe sustains; both equal the old 50/15-frame windows at ~30 fps
+EYES_CLOSED_S = 50 / 30.0 
+YAWN_MIN_S = 15 / 30.0    
+YAWN_TIME_WINDOW_S = 30 * 60.0 
+YAWN_ALERT_COOLDOWN_S = 10 * 60.0 
+YAWN_LOG_PATH = "yawn_log.txt"
+# MediaPipe Tasks model bundle; when present, FaceLandmarker is used instead of FaceMesh
+FACE_LANDMARKER_MODEL = "face_landmarker.task"
+INFERENCE_WIDTH = 480     # frames wider than this are downscaled before MediaPipe
+INFERENCE_STRIDE = 2      # run landmark detection on every Nth frame, reuse results in between
+
+def aligned_empty(shape, dtype=np.uint8, align=64):
+    # C-contiguous array whose data pointer sits on an `align`-byte boundary
+    dtype = np.dtype(dtype)
+    nbytes = int(np.prod(shape)) * dtype.itemsize
+    raw = np.empty(nbytes + align, dtype=np.uint8)
+    offset = -raw.ctypes.data % align
+    return raw[offset:offset + nbytes].view(dtype).reshape(shape)
+
+# One line-buffered handle shared by every stream, so each event hits the file at once
+# and concurrent streams can't interleave partial lines
+_yawn_log = None
+_yawn_log_lock = threading.Lock()
+
+def log_yawn_event(message):
+    global _yawn_log
+    with _yawn_log_lock:
+        if _yawn_log is None:
+            _yawn_log = open(YAWN_LOG_PATH, "a", buffering=1)
+        _yawn_log.write(f"{datetime.now():%Y-%m-%d %H:%M:%S} {message}\n")
+
+
+class FaceModel:
+    # Owns the MediaPipe graph and its scratch buffers. FaceMesh/FaceLandmarker keep
+    # tracking state between frames, so one model must serve a single stream at a time.
+    def __init__(self):
+        self._lm = np.empty((NUM_LANDMARKS, 2), dtype=np.float32)
+        self._rgb_buf = None
+        self._left_idx = np.asarray(LEFT_EYE, dtype=np.int32)
+        self._right_idx = np.asarray(RIGHT_EYE, dtype=np.int32)
+        self._mouth_idx = np.asarray([MOUTH_TOP_LIP, MOUTH_BOTTOM_LIP,
+                                      MOUTH_LEFT_CORNER, MOUTH_RIGHT_CORNER], dtype=np.int32)
+        # Only these rows of _lm are read by ear_mar, so only these are copied per frame
+        self._used_idx = sorted(set(LEFT_EYE + RIGHT_EYE) | {MOUTH_TOP_LIP, MOUTH_BOTTOM_LIP,
+                                                             MOUTH_LEFT_CORNER, MOUTH_RIGHT_CORNER})
+
+        self.landmarker = None
+        self.face_mesh = None
+        self._last_ts_ms = 0
+        if os.path.exists(FACE_LANDMARKER_MODEL):
+            self.landmarker = self._create_landmarker()
+        else:
+            self.face_mesh = mp.solutions.face_mesh.FaceMesh(
+                max_num_faces=1,
+                refine_landmarks=True,  # also refines the eye/lip contours EAR/MAR use; matches FaceLandmarker
+                min_detection_confidence=0.5,
+                min_tracking_confidence=0.5
+            )
+
+    def _create_landmarker(self):
+        # GPU delegate isn't available on every platform (e.g. Windows), so fall back to CPU
+        for delegate in (mp_tasks.BaseOptions.Delegate.GPU, mp_tasks.BaseOptions.Delegate.CPU):
+            options = vision.FaceLandmarkerOptions(
+                base_options=mp_tasks.BaseOptions(model_asset_path=FACE_LANDMARKER_MODEL,
+                                                  delegate=delegate),
+                running_mode=vision.RunningMode.VIDEO,
+                num_faces=1,
+                min_face_detection_confidence=0.5,
+                min_face_presence_confidence=0.5,
+                min_tracking_confidence=0.5
+            )
+            try:
+                return vision.FaceLandmarker.create_from_options(options)
+            except RuntimeError:
+                if delegate == mp_tasks.BaseOptions.Delegate.CPU:
+                    raise
+
+    def _detect(self, rgb_frame):
+        if self.landmarker is None:
+            result = self.face_mesh.process(rgb_frame)
+            if result.multi_face_landmarks:
+                return result.multi_face_landmarks[0].landmark, result
+            return None, result
+
+        # VIDEO mode requires strictly increasing timestamps
+        ts_ms = max(int(time.monotonic() * 1000), self._last_ts_ms + 1)
+        self._last_ts_ms = ts_ms
+        image = mp.Image(image_format=mp.ImageFormat.SRGB, data=rgb_frame)
+        result = self.landmarker.detect_for_video(image, ts_ms)
+        if result.face_landmarks:
+            return result.face_landmarks[0], result
+        return None, result
+
+    def close(self):
+        if self.landmarker is not None:
+            self.landmarker.close()
+        if self.face_mesh is not None:
+            self.face_mesh.close()
+
+    def measure(self, frame):
+        h, w = frame.shape[:2]
+        # Landmarks are normalized, so they still map onto the full-size frame via w, h
+        if w > INFERENCE_WIDTH:
+            size = (INFERENCE_WIDTH, int(h * INFERENCE_WIDTH / w))
+            shape = (size[1], size[0], 3)
+        else:
+            size = None
+            shape = frame.shape
+        # The caller still encodes frame, so resize/convert into one reused buffer
+        if self._rgb_buf is None or self._rgb_buf.shape != shape:
+            # Aligned and contiguous so MediaPipe can take the buffer without repacking it
+            self._rgb_buf = aligned_empty(shape)
+        rgb_frame = self._rgb_buf
+        if size is not None:
+            cv2.resize(frame, size, dst=rgb_frame, interpolation=cv2.INTER_AREA)
+            cv2.cvtColor(rgb_frame, cv2.COLOR_BGR2RGB, dst=rgb_frame)
+        else:
+            cv2.cvtColor(frame, cv2.COLOR_BGR2RGB, dst=rgb_frame)
+        landmarks, result = self._detect(rgb_frame)
+
+        if not landmarks:
+            return None, None, result
+
+        lm = self._lm
+        for i in self._used_idx:
+            p = landmarks[i]
+            lm[i, 0] = p.x * w
+            lm[i, 1] = p.y * h
+
+        ear, mar = ear_mar(lm, self._left_idx, self._right_idx, self._mouth_idx)
+        return ear, mar, result
+
 
 class DrowsinessDetector:
-    def __init__(self):
-        self.eye_counter = 0            
-        self.yawn_frame_counter = 0     
-        self.yawn_timestamps = []       
+    # Per-stream alert state; the landmark work is delegated to a FaceModel
+    def __init__(self, model):
+        self.model = model
+        self.yawn_timestamps = deque()       
         self.ear_alert_active = False   
         self.yawn_alert_active = False  
         self.last_yawn_alert_time = None 
-        
-       
-        self.mp_face_mesh = mp.solutions.face_mesh
-        self.face_mesh = self.mp_face_mesh.FaceMesh(
-            max_num_faces=1,
-            refine_landmarks=True, 
-            min_detection_confidence=0.5,
-            min_tracking_confidence=0.5
-        )
-
-    def calculate_ear(self, eye_points, landmarks):
-        
-        p1 = np.array(landmarks[eye_points[1]]) 
-        p2 = np.array(landmarks[eye_points[5]])
-        A = np.linalg.norm(p2 - p1)
-
-        p3 = np.array(landmarks[eye_points[2]]) 
-        p4 = np.array(landmarks[eye_points[4]]) 
-        B = np.linalg.norm(p4 - p3)
-
-        p5 = np.array(landmarks[eye_points[0]])
-        p6 = np.array(landmarks[eye_points[3]]) 
-        C = np.linalg.norm(p6 - p5)
-
-        ear = (A + B) / (2.0 * C)
-        return ear
-
-    def calculate_mar(self, landmarks):
-        
-        top_lip = np.array(landmarks[MOUTH_TOP_LIP])
-        bottom_lip = np.array(landmarks[MOUTH_BOTTOM_LIP])
-        left_corner = np.array(landmarks[MOUTH_LEFT_CORNER])
-        right_corner = np.array(landmarks[MOUTH_RIGHT_CORNER])
-
-        vertical_dist = np.linalg.norm(top_lip - bottom_lip)
-        horizontal_dist = np.linalg.norm(left_corner - right_corner)
-
-        mar = vertical_dist / horizontal_dist
-        return mar
+        self._stride = INFERENCE_STRIDE
+        self._tick = 0
+        # Monotonic start of the current closed-eyes / open-mouth run, None outside a run
+        self._eyes_closed_since = None
+        self._mouth_open_since = None
+        self._last_ear = None
+        self._last_mar = None
+        self._last_alert_text = ""
 
     def process_frame(self, frame):
-        h, w = frame.shape[:2]
-        rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        result = self.face_mesh.process(rgb_frame)
-        current_time = datetime.now()
+        skip = self._tick % self._stride
+        self._tick += 1
+        if skip:
+            return self._last_ear, self._last_mar, self._last_alert_text, None
 
-        ear = None
-        mar = None
-        alert_text = "" 
-
-        if result.multi_face_landmarks:
-            mesh_points = result.multi_face_landmarks[0]
-            landmarks = [(int(p.x * w), int(p.y * h)) for p in mesh_points.landmark]
+        ear, mar, result = self.model.measure(frame)
+        now = time.monotonic()
 
-            left_ear = self.calculate_ear(LEFT_EYE, landmarks)
-            right_ear = self.calculate_ear(RIGHT_EYE, landmarks)
-            ear = (left_ear + right_ear) / 2.0
-            
-            mar = self.calculate_mar(landmarks)
+        alert_text = "" 
 
+        if ear is not None:
             if ear < EAR_THRESHOLD:
-                self.eye_counter += 1
-                if self.eye_counter >= CONSEC_EYE_FRAMES:
-                    self.ear_alert_active = True
-                    alert_text = "DROWSINESS DETECTED via EYES"
+                if self._eyes_closed_since is None:
+                    self._eyes_closed_since = now
+                self.ear_alert_active = now - self._eyes_closed_since >= EYES_CLOSED_S
             else:
-                self.eye_counter = 0
+                self._eyes_closed_since = None
                 self.ear_alert_active = False
 
             if mar > MAR_THRESHOLD:
-                self.yawn_frame_counter += 1
+                if self._mouth_open_since is None:
+                    self._mouth_open_since = now
             else:
-                if self.yawn_frame_counter >= YAWN_CONSEC_FRAMES:
-                    self.yawn_timestamps.append(current_time)
-                self.yawn_frame_counter = 0 
-            self.yawn_timestamps = [t for t in self.yawn_timestamps if current_time - t <= YAWN_TIME_WINDOW]
+                if self._mouth_open_since is not None and \
+                   now - self._mouth_open_since >= YAWN_MIN_S:
+                    self.yawn_timestamps.append(now)
+                    log_yawn_event("yawn detected")
+                self._mouth_open_since = None
+            while self.yawn_timestamps and now - self.yawn_timestamps[0] > YAWN_TIME_WINDOW_S:
+                self.yawn_timestamps.popleft()
             
             if len(self.yawn_timestamps) > 3: 
                 if self.last_yawn_alert_time is None or \
-                   (current_time - self.last_yawn_alert_time) > YAWN_ALERT_COOLDOWN:
+                   (now - self.last_yawn_alert_time) > YAWN_ALERT_COOLDOWN_S:
                     self.yawn_alert_active = True
-                    self.last_yawn_alert_time = current_time 
+                    self.last_yawn_alert_time = now 
+                    log_yawn_event(f"yawn alert ({len(self.yawn_timestamps)} recent yawns)")
                     if not self.ear_alert_active: 
                         alert_text = "DROWSINESS DETECTED via YAWNS"
                 else:
@@ -124,4 +227,6 @@ class DrowsinessDetector:
                 alert_text = "DROWSINESS DETECTED (YAWNS)"
             else:
                 alert_text = "" 
+
+        self._last_ear, self._last_mar, self._last_alert_text = ear, mar, alert_text
         return ear, mar, alert_text, result
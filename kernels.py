@@ -0,0 +1,48 @@
+import math
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+
+if njit is not None:
+    @njit(cache=True, fastmath=True)
+    def eye_aspect_ratio(lm, eye):
+        A = math.hypot(lm[eye[1], 0] - lm[eye[5], 0], lm[eye[1], 1] - lm[eye[5], 1])
+        B = math.hypot(lm[eye[2], 0] - lm[eye[4], 0], lm[eye[2], 1] - lm[eye[4], 1])
+        C = math.hypot(lm[eye[0], 0] - lm[eye[3], 0], lm[eye[0], 1] - lm[eye[3], 1])
+        return (A + B) / (2.0 * C)
+
+    @njit(cache=True, fastmath=True)
+    def ear_mar(lm, left_idx, right_idx, mouth_idx):
+        # mouth_idx is (top lip, bottom lip, left corner, right corner)
+        ear = (eye_aspect_ratio(lm, left_idx) + eye_aspect_ratio(lm, right_idx)) / 2.0
+
+        top, bottom, left, right = mouth_idx[0], mouth_idx[1], mouth_idx[2], mouth_idx[3]
+        vertical_dist = math.hypot(lm[top, 0] - lm[bottom, 0], lm[top, 1] - lm[bottom, 1])
+        horizontal_dist = math.hypot(lm[left, 0] - lm[right, 0], lm[left, 1] - lm[right, 1])
+        mar = vertical_dist / horizontal_dist
+        return ear, mar
+else:
+    # Rows of the stacked (left eye, right eye, mouth) points whose distances we need:
+    # left A, B, C, right A, B, C, mouth vertical, mouth horizontal
+    _PAIR_A = np.array([1, 2, 0, 7, 8, 6, 12, 14])
+    _PAIR_B = np.array([5, 4, 3, 11, 10, 9, 13, 15])
+
+    def ear_mar(lm, left_idx, right_idx, mouth_idx):
+        pts = lm[np.concatenate((left_idx, right_idx, mouth_idx))]
+        d = pts[_PAIR_A] - pts[_PAIR_B]
+        dist = np.sqrt(np.einsum('ij,ij->i', d, d))
+
+        left_ear = (dist[0] + dist[1]) / (2.0 * dist[2])
+        right_ear = (dist[3] + dist[4]) / (2.0 * dist[5])
+        mar = dist[6] / dist[7]
+        return float((left_ear + right_ear) / 2.0), float(mar)
+
+
+# Compile ahead of the first frame so the stream doesn't stall on JIT
+_warm_lm = np.arange(16, dtype=np.float32).reshape(8, 2)
+ear_mar(_warm_lm, np.arange(6, dtype=np.int32), np.arange(6, dtype=np.int32),
+        np.arange(4, dtype=np.int32))